@@ -0,0 +1,273 @@
+import os
+import math
+import time
+import argparse
+import subprocess
+import tempfile
+import tracemalloc
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+from imageio_ffmpeg import get_ffmpeg_exe
+from ripple_engine import GEOMETRY_CACHE, FrameCache, parallel_lines, path_renderer, render_concentric_circles, render_frame, render_frames, render_parallel_lines, render_video, square_rings, write_frames
+
+def peak_streaming_memory(image, ripple_type, num_frames, scale_factor=2, fps=10):
+    # Peak Python/NumPy memory while streaming a num_frames sweep into an MP4,
+    # not counting GEOMETRY_CACHE, which keeps one entry per step up to its own cap
+    GEOMETRY_CACHE.clear()
+    frames = (frame for _, frame in render_frames(image, ripple_type, 5, 5 + num_frames - 1, 1, scale_factor))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tracemalloc.start()
+        write_frames(frames, os.path.join(tmp_dir, "benchmark.mp4"), fps=fps)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return peak - GEOMETRY_CACHE.nbytes
+
+def check_memory_ceiling(image, ripple_type="Circular", num_frames=40, scale_factor=2, max_extra_frames=2):
+    """Check that streaming a long sweep peaks no higher than a short one plus a few frames."""
+    width, height = image.size
+    frame_bytes = width * scale_factor * height * scale_factor * 3
+
+    short_peak = peak_streaming_memory(image, ripple_type, 2, scale_factor)
+    long_peak = peak_streaming_memory(image, ripple_type, num_frames, scale_factor)
+    ceiling = short_peak + max_extra_frames * frame_bytes
+    print(f"{ripple_type}: 2 frames peak {short_peak / 1e6:.1f} MB, {num_frames} frames peak {long_peak / 1e6:.1f} MB, ceiling {ceiling / 1e6:.1f} MB")
+    assert long_peak <= ceiling, f"Peak memory grew with animation length: {long_peak} > {ceiling} bytes"
+
+def legacy_stroke(image, draw, step_size, scale_factor, grayscale, line_thickness):
+    """The original per-pixel stroke: one getpixel and one draw.line call per sample."""
+    def stroke(x, y, end):
+        r, g, b = image.getpixel((x // scale_factor, y // scale_factor))
+        if grayscale:
+            r = g = b = (r + g + b) // 3
+        thickness = max(line_thickness, int((225 - ((r + g + b) // 3)) / 225 * step_size))
+        draw.line([x, y, *end], fill=(r, g, b), width=thickness)
+    return stroke
+
+def legacy_circle_frame(image, step_size, scale_factor=2, grayscale=False, line_thickness=1):
+    """One frame of the original per-segment concentric circles loop, for reference."""
+    width, height = image.size[0] * scale_factor, image.size[1] * scale_factor
+    center_x, center_y = width // 2, height // 2
+    output_image = Image.new("RGB", (width, height), (255, 255, 255))
+    stroke = legacy_stroke(image, ImageDraw.Draw(output_image), step_size, scale_factor, grayscale, line_thickness)
+
+    for radius in range(0, int(math.hypot(center_x, center_y)), step_size):
+        for i in range(360):
+            angle, next_angle = i / 360 * 2 * math.pi, (i + 1) / 360 * 2 * math.pi
+            x, y = int(center_x + radius * math.cos(angle)), int(center_y + radius * math.sin(angle))
+            if 0 <= x < width and 0 <= y < height:
+                stroke(x, y, (int(center_x + radius * math.cos(next_angle)), int(center_y + radius * math.sin(next_angle))))
+    return np.asarray(output_image)
+
+def legacy_square_frame(image, step_size, scale_factor=2, grayscale=False, line_thickness=1):
+    """One frame of the original per-edge-pixel concentric squares loop, for reference."""
+    width, height = image.size[0] * scale_factor, image.size[1] * scale_factor
+    center_x, center_y = width // 2, height // 2
+    output_image = Image.new("RGB", (width, height), (255, 255, 255))
+    stroke = legacy_stroke(image, ImageDraw.Draw(output_image), step_size, scale_factor, grayscale, line_thickness)
+
+    for radius in range(0, int(math.hypot(center_x, center_y)), step_size):
+        left, top, right, bottom = center_x - radius, center_y - radius, center_x + radius, center_y + radius
+        for x in range(max(left, 0), min(right + 1, width)):
+            for y in (top, bottom):
+                if 0 <= y < height:
+                    stroke(x, y, (x + 1, y))
+        for y in range(max(top, 0), min(bottom + 1, height)):
+            for x in (left, right):
+                if 0 <= x < width:
+                    stroke(x, y, (x, y + 1))
+    return np.asarray(output_image)
+
+def legacy_parallel_lines_frame(image, step_size, scale_factor=2, grayscale=False, line_thickness=1):
+    """One frame of the original per-pixel parallel lines loop, for reference."""
+    width, height = image.size[0] * scale_factor, image.size[1] * scale_factor
+    output_image = Image.new("RGB", (width, height), (255, 255, 255))
+    stroke = legacy_stroke(image, ImageDraw.Draw(output_image), step_size, scale_factor, grayscale, line_thickness)
+    for y in range(0, height, step_size):
+        for x in range(width):
+            stroke(x, y, (x + 1, y))
+    return np.asarray(output_image)
+
+def ms_per_frame(render, source, steps, **options):
+    start = time.perf_counter()
+    frames = [render(source, step_size, **options) for step_size in steps]
+    return (time.perf_counter() - start) * 1000 / len(steps), frames
+
+def benchmark_renderer(label, image, legacy, path, renderer=None, steps=range(5, 21, 3), legacy_steps=(5, 20), scale_factor=2, line_thickness=1):
+    """Time the shape's path renderer, and its dedicated ``renderer`` if it has one, against the original loop.
+
+    The dedicated renderer must match the path renderer exactly; the legacy
+    PIL loop draws its pixel-wide strokes slightly differently, so only the
+    difference to it is reported.
+    """
+    image = image.convert("RGB")
+    source = np.asarray(image)
+    options = dict(scale_factor=scale_factor, line_thickness=line_thickness)
+
+    legacy_ms, legacy_frames = ms_per_frame(lambda _, step_size, **kw: legacy(image, step_size, **kw), None, legacy_steps, **options)
+    print(f"{label} legacy: {legacy_ms:.1f} ms/frame")
+    renderers = {"path": path_renderer(path)}
+    if renderer is not None:
+        renderers[renderer.__name__] = renderer
+    results = {}
+    for name, render in renderers.items():
+        GEOMETRY_CACHE.clear()
+        cold_ms, _ = ms_per_frame(render, source, steps, **options)
+        warm_ms, results[name] = ms_per_frame(render, source, steps, **options)
+        diffs = [np.abs(render(source, step_size, **options).astype(np.int16) - expected) for step_size, expected in zip(legacy_steps, legacy_frames)]
+        print(f"{label} {name}: cold {cold_ms:.1f} ms/frame, warm {warm_ms:.1f} ms/frame, "
+              f"vs legacy mean diff {np.mean(diffs):.2f}, max diff {max(d.max() for d in diffs)}")
+    if renderer is not None:
+        for step_size, expected, frame in zip(steps, results["path"], results[renderer.__name__]):
+            assert np.array_equal(expected, frame), f"{renderer.__name__} differs from the path renderer at step {step_size}"
+
+def check_circle_tolerance(steps=(5, 10, 20), scale_factor=2, max_stray=0.015):
+    """Check render_concentric_circles against the original loop within its documented tolerance.
+
+    Uses the blurred-noise 80x64 source the docstring's figures were measured
+    on; each thickness range has its own bound on the mean colour difference
+    over the pixels both renderers paint.
+    """
+    rng = np.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 256, (64, 80, 3), dtype=np.uint8)).filter(ImageFilter.GaussianBlur(2))
+    source = np.asarray(image)
+    for thicknesses, max_mean_diff in (((1, 3, 5), 1.5), ((8, 10, 15), 3), ((20, 30), 5.1)):
+        means, strays = [], []
+        for line_thickness in thicknesses:
+            for step_size in steps:
+                expected = legacy_circle_frame(image, step_size, scale_factor, line_thickness=line_thickness).astype(np.int16)
+                frame = render_concentric_circles(source, step_size, scale_factor, line_thickness=line_thickness).astype(np.int16)
+                legacy_painted, painted = (expected != 255).any(-1), (frame != 255).any(-1)
+                means.append(np.abs(expected - frame)[legacy_painted & painted].mean())
+                stray = (legacy_painted & ~grow(painted)).sum() + (painted & ~grow(legacy_painted)).sum()
+                strays.append(stray / (legacy_painted | painted).sum())
+        print(f"Circular vs legacy, line_thickness {thicknesses[0]}-{thicknesses[-1]}: "
+              f"mean diff up to {max(means):.1f}, stray pixels up to {max(strays):.2%}")
+        assert max(means) <= max_mean_diff, f"Circles differ from the legacy loop by {max(means):.1f} levels at line_thickness {thicknesses}"
+        assert max(strays) <= max_stray, f"{max(strays):.2%} of circle pixels are over a pixel from the legacy strokes"
+
+def grow(mask):
+    """``mask`` dilated by one pixel in every direction."""
+    padded = np.pad(mask, 1)
+    grown = np.zeros_like(mask)
+    for dy in range(3):
+        for dx in range(3):
+            grown |= padded[dy:dy + mask.shape[0], dx:dx + mask.shape[1]]
+    return grown
+
+def benchmark_sweep(image, ripple_type, initial_step_size=1, max_step_size=100, scale_factor=2, grayscale=False):
+    """Time a long step sweep, which prepares the image once, and check it against single frames."""
+    checked = {initial_step_size, (initial_step_size + max_step_size) // 2, max_step_size}
+    frames = {}
+    GEOMETRY_CACHE.clear()
+    start = time.perf_counter()
+    for step_size, frame in render_frames(image, ripple_type, initial_step_size, max_step_size, 1, scale_factor, grayscale):
+        if step_size in checked:
+            frames[step_size] = frame
+    sweep_ms = (time.perf_counter() - start) * 1000 / (max_step_size - initial_step_size + 1)
+    print(f"{ripple_type} sweep {initial_step_size}-{max_step_size}: {sweep_ms:.1f} ms/frame")
+    source = np.asarray(image.convert("RGB"))
+    for step_size in sorted(checked):
+        expected = render_frame(source, ripple_type, step_size, scale_factor, grayscale)
+        assert np.array_equal(frames[step_size], expected), f"{ripple_type} sweep differs from a single frame at step {step_size}"
+
+def check_geometry_reuse(ripple_type, size=(1024, 768), scale_factor=2):
+    """Check that a second photo of the same size renders the default sweep from cached geometry."""
+    rng = np.random.default_rng(1)
+    GEOMETRY_CACHE.clear()
+    for photo in ("first", "second"):
+        image = Image.fromarray(rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8))
+        before = GEOMETRY_CACHE.stats()
+        start = time.perf_counter()
+        num_frames = sum(1 for _ in render_frames(image, ripple_type, scale_factor=scale_factor))
+        after = GEOMETRY_CACHE.stats()
+        hits, misses = after["hits"] - before["hits"], after["misses"] - before["misses"]
+        print(f"{ripple_type} {size[0]}x{size[1]} {photo} photo: {(time.perf_counter() - start) * 1000 / num_frames:.0f} ms/frame, "
+              f"{hits} hits, {misses} misses, cache {after['memory_bytes'] / 1e6:.0f} MB")
+    assert hits == num_frames and not misses, f"{ripple_type} geometry was not reused for a second photo of the same size"
+
+def check_frame_cache_disk(image, ripple_type="Circular", num_frames=20, scale_factor=2):
+    """Check that spilled frames stay under the disk cap and that a broken cache directory only costs misses."""
+    width, height = image.size
+    frame_bytes = width * scale_factor * height * scale_factor * 3
+    sweep = (image, ripple_type, 5, 5 + num_frames - 1, 1, scale_factor)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = FrameCache(2 * frame_bytes, os.path.join(tmp_dir, "frames"), max_disk_bytes=5 * frame_bytes)
+        expected = [frame for _, frame in render_frames(*sweep, frame_cache=cache)]
+        on_disk = sum(entry.stat().st_size for entry in os.scandir(cache.directory))
+        assert on_disk == cache.disk_bytes <= cache.max_disk_bytes, f"Frame cache holds {on_disk} bytes on disk, over its {cache.max_disk_bytes} byte cap"
+        again = [frame for _, frame in render_frames(*sweep, frame_cache=FrameCache(2 * frame_bytes, cache.directory))]
+        assert all(np.array_equal(a, b) for a, b in zip(expected, again)), "Frames loaded from the disk cache differ"
+
+        # A cache directory that cannot be created, e.g. one owned by another user
+        blocker = os.path.join(tmp_dir, "not_a_directory")
+        open(blocker, "w").close()
+        broken = FrameCache(2 * frame_bytes, os.path.join(blocker, "frames"))
+        frames = [frame for _, frame in render_frames(*sweep, frame_cache=broken)]
+        assert all(np.array_equal(a, b) for a, b in zip(expected, frames)), "An unwritable frame cache changed the frames"
+        assert not broken.disk_bytes and broken.stats()["misses"] == num_frames
+
+        # A directory other users can enter is not trusted with frames
+        shared = os.path.join(tmp_dir, "shared")
+        os.mkdir(shared)
+        os.chmod(shared, 0o755)
+        for _ in render_frames(*sweep, frame_cache=FrameCache(2 * frame_bytes, shared)):
+            pass
+        assert not os.listdir(shared), "Frames were spilled into a directory other users can read"
+    print(f"Frame cache disk: {len(expected)} frames under a {5 * frame_bytes / 1e6:.1f} MB cap, unwritable and shared directories ok")
+
+def test_clip(path, seconds, size=(320, 240), fps=24):
+    """Write a synthetic H.264 clip with an AAC tone to ``path``."""
+    subprocess.run([get_ffmpeg_exe(), "-y", "-f", "lavfi", "-i", f"testsrc=size={size[0]}x{size[1]}:rate={fps}",
+                    "-f", "lavfi", "-i", "sine=frequency=440", "-t", str(seconds),
+                    "-c:v", "libx264", "-pix_fmt", "yuv420p", "-c:a", "aac", path], check=True, capture_output=True)
+
+def check_video_memory(ripple_type="Circular", step_size=10, seconds=(10, 20), scale_factor=2, max_extra_frames=2):
+    """Check that the video pipeline's peak memory does not grow with the clip length.
+
+    The shortest clip sets the baseline, so it must be long enough for the
+    stage queues to fill; a few seconds at 24 fps peak lower than any longer clip.
+    """
+    width, height = 320, 240
+    frame_bytes = width * scale_factor * height * scale_factor * 3
+    peaks = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for length in seconds:
+            input_path = os.path.join(tmp_dir, f"clip_{length}.mp4")
+            test_clip(input_path, length, (width, height))
+            tracemalloc.start()
+            start = time.perf_counter()
+            num_frames = render_video(input_path, os.path.join(tmp_dir, "ripple.mp4"), ripple_type, step_size, scale_factor)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            peaks.append(peak)
+            print(f"{ripple_type} video, {num_frames} frames: {num_frames / elapsed:.1f} frames/s, peak {peak / 1e6:.1f} MB")
+    ceiling = peaks[0] + max_extra_frames * frame_bytes
+    assert peaks[-1] <= ceiling, f"Video peak memory grew with clip length: {peaks[-1]} > {ceiling} bytes"
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the ripple engine.")
+    parser.add_argument("image", nargs="?", help="Input image; a random test image is used if omitted.")
+    parser.add_argument("--size", type=int, default=256, help="Size of the random test image.")
+    parser.add_argument("--frames", type=int, default=40, help="Length of the long sweep in the memory check.")
+    parser.add_argument("--sweep", type=int, default=100, help="Largest step of the timed 1..N sweeps.")
+    args = parser.parse_args()
+
+    if args.image:
+        image = Image.open(args.image).convert("RGB")
+    else:
+        image = Image.fromarray(np.random.default_rng(0).integers(0, 256, (args.size, args.size, 3), dtype=np.uint8))
+
+    check_circle_tolerance()
+    benchmark_renderer("Square", image, legacy_square_frame, square_rings)
+    benchmark_renderer("Parallel Lines", image, legacy_parallel_lines_frame, parallel_lines, render_parallel_lines)
+    for ripple_type in ("Circular", "Square", "Triangular"):
+        check_geometry_reuse(ripple_type)
+    for ripple_type in ("Circular", "Square", "Triangular", "Parallel Lines"):
+        benchmark_sweep(image, ripple_type, 1, args.sweep)
+        check_memory_ceiling(image, ripple_type, args.frames)
+    check_frame_cache_disk(image)
+    check_video_memory()
+
+if __name__ == "__main__":
+    main()
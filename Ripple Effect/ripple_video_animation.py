@@ -0,0 +1,28 @@
+import gradio as gr
+from ripple_engine import RENDERERS, render_video
+
+def process_video(video_path, ripple_type, step_size, scale_factor, grayscale, line_thickness, workers=1):
+    # The clip is decoded, rendered and encoded as a stream with its audio copied through
+    output_path = "ripple_video.mp4"
+    num_frames = render_video(video_path, output_path, ripple_type, int(step_size), int(scale_factor), grayscale, int(line_thickness), workers=int(workers))
+    print(f"Saved: {output_path} ({num_frames} frames)")
+    return output_path
+
+iface = gr.Interface(
+    fn=process_video,
+    inputs=[
+        gr.Video(label="Upload Video"),
+        gr.Dropdown(choices=list(RENDERERS), value="Circular", label="Ripple Type"),
+        gr.Number(label="Step Size", value=10),
+        gr.Number(label="Scale Factor", value=1),
+        gr.Checkbox(label="Grayscale"),
+        gr.Number(label="Line Thickness", value=1),
+        gr.Number(label="Render Processes (0 = all cores)", value=1)
+    ],
+    outputs=gr.Video(label="Ripple Video"),
+    title="Ripple Video",
+    description="Upload a video clip, then choose a ripple type and step size to apply to every frame. The audio is kept."
+)
+
+if __name__ == "__main__":
+    iface.launch()
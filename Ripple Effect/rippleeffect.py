@@ -1,39 +1,13 @@
-from PIL import Image, ImageDraw
-import math
+from PIL import Image
+import numpy as np
+from ripple_engine import render_concentric_circles
 
 def create_concentric_circles(input_path, output_path, step_size=5, num_points=360, scale_factor=2):
     # Load the image
     image = Image.open(input_path).convert("L")  # Convert to grayscale
 
-    # Get the size of the image and scale it
-    width, height = image.size
-    width *= scale_factor
-    height *= scale_factor
-
-    # Create a new image for the output with increased resolution
-    output_image = Image.new("L", (width, height), 255)  # White background
-    draw = ImageDraw.Draw(output_image)
-
-    # Center coordinates
-    center_x = width // 2
-    center_y = height // 2
-
-    # Draw concentric circles covering the entire image
-    max_radius = int(math.hypot(center_x, center_y))  # Distance from center to the farthest corner
-    for radius in range(0, max_radius, step_size):
-        for i in range(num_points):
-            angle = (i / num_points) * 2 * math.pi
-            x = int(center_x + radius * math.cos(angle))
-            y = int(center_y + radius * math.sin(angle))
-            
-            if 0 <= x < width and 0 <= y < height:
-                intensity = image.getpixel((x // scale_factor, y // scale_factor))
-                thickness = max(1, int((225 - intensity) / 225 * step_size))
-                next_angle = ((i + 1) / num_points) * 2 * math.pi
-                next_x = int(center_x + radius * math.cos(next_angle))
-                next_y = int(center_y + radius * math.sin(next_angle))
-                
-                draw.line([x, y, next_x, next_y], fill=0, width=thickness)
+    # Draw concentric circles covering the entire image, with higher resolution
+    output_image = Image.fromarray(render_concentric_circles(np.asarray(image), step_size, scale_factor, num_points=num_points, fill=0))
 
     # Save the result
     output_image.save(output_path)
@@ -1,55 +1,105 @@
 import gradio as gr
-from diffusers import StableDiffusionPipeline
-import torch
-from datetime import datetime
 from PIL import Image
-from gfpgan import GFPGANer
 import numpy as np
+import os
+import queue
+import atexit
+from sd_pipeline import (SCHEDULERS, BackgroundLoader, BatchScheduler, ImageWriter, OutputStore, PromptEmbeddingCache, Stage,
+                         launch_with_warmup, load_pipeline)
 
-# Load the pre-trained Stable Diffusion v1.5 model
+# The pre-trained Stable Diffusion v1.5 model
 model_id = "runwayml/stable-diffusion-v1-5"
-device = "cuda" if torch.cuda.is_available() else "cpu"
-
-pipe = StableDiffusionPipeline.from_pretrained(model_id)
-pipe = pipe.to(device)
-
-# Load the GFPGAN model
-gfpgan = GFPGANer(
-    model_path='C:\\Users\\laksh\\GFPGAN\\experiments\\pretrained_models\\GFPGANv1.4.pth',
-    upscale=4,
-    arch='clean',
-    channel_multiplier=2,
-    bg_upsampler=None
-)
 
-def generate_and_upscale_image(prompt):
-    # Generate an image
-    image = pipe(prompt).images[0]
+# Requests from concurrent users are generated together in batched pipeline calls
+MAX_BATCH_SIZE = 4
+MAX_WAIT_SECONDS = 0.05
+# Our traffic repeats a few hundred templated prompts: their text embeddings are
+# cached, and kept across restarts in the file PROMPT_EMBEDDING_CACHE names, if
+# set (embeddings saved for another model are ignored, so use a file per app)
+EMBEDDING_CACHE_PATH = os.environ.get("PROMPT_EMBEDDING_CACHE")
+# Face restoration runs as its own stage, so the diffusion model starts on the
+# next prompt while earlier images are restored. Each restore worker holds its
+# own GFPGAN model; at most RESTORE_QUEUE_SIZE images wait for one
+RESTORE_WORKERS = 2
+RESTORE_QUEUE_SIZE = 4
+# GFPGAN detects faces on the whole image, so it is never tiled: a face split
+# across tiles would not be found
+RESTORE_SCALE = 4
+# Outputs are written in the background once the response is on its way;
+# anything still queued at shutdown is written before the process exits
+PNG_COMPRESS_LEVEL = 1
+
+def load_scheduler():
+    import torch
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    pipe = load_pipeline(model_id, device)
+    embedding_cache = PromptEmbeddingCache(pipe, max_entries=1024, path=EMBEDDING_CACHE_PATH)
+    atexit.register(embedding_cache.save)
+    return BatchScheduler(pipe, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_WAIT_SECONDS, embedding_cache=embedding_cache)
+
+def load_gfpgan():
+    from gfpgan import GFPGANer
 
-    # Convert PIL image to numpy array
-    img_array = np.array(image)
+    return GFPGANer(
+        model_path='C:\\Users\\laksh\\GFPGAN\\experiments\\pretrained_models\\GFPGANv1.4.pth',
+        upscale=RESTORE_SCALE,
+        arch='clean',
+        channel_multiplier=2,
+        bg_upsampler=None
+    )
 
-    # Upscale the image using GFPGAN
-    _, _, restored_img = gfpgan.enhance(img_array, has_aligned=False, only_center_face=False, paste_back=True)
+def load_gfpgan_pool():
+    # GFPGANer keeps per-image face state, so every restore worker gets its own
+    pool = queue.Queue()
+    for _ in range(RESTORE_WORKERS):
+        pool.put(load_gfpgan())
+    return pool
 
+# Both models load in the background, side by side, once the app is up
+model = BackgroundLoader(load_scheduler, "Stable Diffusion")
+restorer = BackgroundLoader(load_gfpgan_pool, "GFPGAN")
+
+def restore_faces(image):
+    pool = restorer.get()
+    gfpgan = pool.get()
+    try:
+        # Upscale the image using GFPGAN
+        _, _, restored_img = gfpgan.enhance(np.array(image), has_aligned=False, only_center_face=False, paste_back=True)
+    finally:
+        pool.put(gfpgan)
     # Convert numpy array back to PIL image
-    upscaled_image = Image.fromarray(restored_img)
+    return Image.fromarray(restored_img)
+
+restore_stage = Stage(restore_faces, workers=RESTORE_WORKERS, max_queue=RESTORE_QUEUE_SIZE, name="restore")
+writer = ImageWriter(compress_level=PNG_COMPRESS_LEVEL)
+# Outputs get unique names in sharded directories, indexed by prompt and settings
+store = OutputStore(writer=writer)
+
+def generate_and_upscale_image(prompt, sampler="pndm", steps=0):
+    # Generate an image; during warm-up the request waits for the models
+    scheduler = model.get()
+    image = scheduler.submit(prompt, scheduler=sampler, num_inference_steps=int(steps) or None)[0]
 
-    # Generate output file path with timestamp
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_path = f"generated_image_{timestamp}.png"
-    upscaled_output_path = f"upscaled_image_{timestamp}.png"
+    # Hand the image to the restore stage; the scheduler is already free for the next prompt
+    upscaled_image = restore_stage.submit(image).result()
+    print(f"Generation: {scheduler.stats()}, restore: {restore_stage.stats()}, prompt embeddings: {scheduler.embedding_cache.stats()}")
 
-    # Save the generated and upscaled images
-    image.save(output_path)
-    upscaled_image.save(upscaled_output_path)
+    # Save the generated and upscaled images; the upscaled one is indexed with the id of its source
+    settings = {"prompt": prompt, "model": model_id, "scheduler": sampler, "steps": int(steps) or None}
+    generated_id, _ = store.save(image, kind="generated", **settings)
+    store.save(upscaled_image, kind="restored", source=generated_id, **settings)
 
     return upscaled_image
 
 # Create Gradio interface
 iface = gr.Interface(
     fn=generate_and_upscale_image,
-    inputs="text",
+    inputs=[
+        gr.Textbox(label="Prompt"),
+        gr.Dropdown(choices=sorted(SCHEDULERS), value="pndm", label="Scheduler"),
+        gr.Number(label="Steps (0 for the scheduler's default)", value=0, precision=0),
+    ],
     outputs="image",
     title="Text-to-Image Generation and Upscaling",
     description="Enter a text prompt to generate an image using Stable Diffusion and upscale it using GFPGAN.",
@@ -57,4 +107,7 @@ iface = gr.Interface(
 
 # Launch the web application
 if __name__ == "__main__":
-    iface.launch(share=True)
+    # Let enough requests in at once for the scheduler to fill its batches while
+    # earlier requests are still being restored
+    concurrency_limit = MAX_BATCH_SIZE + RESTORE_WORKERS + RESTORE_QUEUE_SIZE
+    launch_with_warmup(iface, [model, restorer], concurrency_limit=concurrency_limit, share=True)
@@ -1,23 +1,38 @@
 # generate_image.py
 
-from diffusers import StableDiffusionPipeline
-import torch
+import argparse
+from sd_pipeline import SCHEDULERS, OutputStore, PromptEmbeddingCache, load_pipeline, scheduled_options
+
+parser = argparse.ArgumentParser(description="Generate an image with Stable Diffusion.")
+parser.add_argument("--scheduler", choices=sorted(SCHEDULERS), help="Denoising scheduler; the model's own (PNDM) if omitted.")
+parser.add_argument("--steps", type=int, help="Number of denoising steps; defaults to the scheduler's usual count.")
+parser.add_argument("--embedding-cache", help="File that keeps prompt embeddings between runs.")
+parser.add_argument("--cpu-optimize", action="store_true", help="Tune the pipeline for CPU inference (threads, channels-last).")
+parser.add_argument("--bfloat16", action="store_true", help="With --cpu-optimize, run the UNet under bfloat16 autocast; can be slower, even on CPUs with native bfloat16.")
+parser.add_argument("--compile-unet", action="store_true", help="With --cpu-optimize, compile the UNet; the first image pays for the compilation.")
+parser.add_argument("--attention-slicing", action="store_true", help="With --cpu-optimize, slice attention to save memory at some speed.")
+args = parser.parse_args()
 
 # Load the pre-trained Stable Diffusion model
 model_id = "CompVis/stable-diffusion-v1-4"
 device = "cpu"
 
 # Initialize the pipeline
-pipe = StableDiffusionPipeline.from_pretrained(model_id)
-pipe = pipe.to(device)
+pipe = load_pipeline(model_id, device, cpu_optimize=args.cpu_optimize, bfloat16=args.bfloat16, compile_unet=args.compile_unet,
+                     attention_slicing=args.attention_slicing)
 
 # Define your prompt
 prompt = "A beautiful sunset over a mountain range"
 
+# With --embedding-cache, prompt embeddings are kept on disk, so running again with the same prompt skips the text encoder
+embedding_cache = PromptEmbeddingCache(pipe, path=args.embedding_cache)
+
 # Generate an image
-image = pipe(prompt).images[0]
+options = scheduled_options(pipe, {"scheduler": args.scheduler, "num_inference_steps": args.steps})
+image = pipe(**embedding_cache.pipeline_inputs(prompt), **options).images[0]
+embedding_cache.save()
 
-# Save the generated image
-image.save("generated_image.png")
+# Save the generated image under a unique name, indexed with its prompt and settings
+_, output_path = OutputStore().save(image, prompt=prompt, model=model_id, scheduler=args.scheduler, steps=args.steps)
 
-print("Image generated and saved as 'generated_image.png'")
\ No newline at end of file
+print(f"Image generated and saved as '{output_path}'")
\ No newline at end of file
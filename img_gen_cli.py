@@ -1,33 +1,162 @@
-#This is the code for a stable diffuser cli and it saves the image using timestamp
+#This is the code for a stable diffuser cli and it saves the image in the output store (see sd_pipeline.OutputStore)
+#
+# Loading the model takes far longer than generating one image, so the CLI can
+# hand prompts to a daemon that keeps the pipeline loaded:
+#   python img_gen_cli.py --serve            start the daemon
+#   python img_gen_cli.py "a prompt"         uses the daemon if one is running,
+#                                            otherwise loads the model itself
 
 import argparse
-from diffusers import StableDiffusionPipeline
-import torch
-from datetime import datetime
+import json
+import os
+import socket
+import socketserver
+import tempfile
+from sd_pipeline import DEFAULT_OUTPUT_DIR, SCHEDULERS, OutputStore, PromptEmbeddingCache, load_pipeline, scheduled_options
 
-def generate_image(prompt):
-    # Load the pre-trained Stable Diffusion model
-    model_id = "CompVis/stable-diffusion-v1-4"
-    device = "cpu"  # Use CPU
+# torch and diffusers are only imported where the model is loaded (see
+# sd_pipeline), so a CLI call served by the daemon starts instantly
+MODEL_ID = "CompVis/stable-diffusion-v1-4"
+# The socket lives in a directory only this user can enter: $XDG_RUNTIME_DIR, or
+# one of our own in the temp dir, so other users can neither connect to the
+# daemon nor put a socket of theirs in its place
+RUNTIME_DIR = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(tempfile.gettempdir(), f"img_gen_{os.getuid() if hasattr(os, 'getuid') else 0}")
+DEFAULT_SOCKET = os.path.join(RUNTIME_DIR, "img_gen.sock")
 
-    # Initialize the pipeline
-    pipe = StableDiffusionPipeline.from_pretrained(model_id)
-    pipe = pipe.to(device)
+def _owned_by_other_user(path):
+    return hasattr(os, "getuid") and os.lstat(path).st_uid != os.getuid()
 
-    # Generate an image
-    image = pipe(prompt).images[0]
+def _make_private_dir(path):
+    # Create path for this user alone, refusing one that another user made first
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    status = os.lstat(path)
+    if _owned_by_other_user(path) or status.st_mode & 0o077:
+        raise SystemExit(f"{path} is not private to this user (mode {status.st_mode & 0o777:o}); remove it or pass --socket")
 
-    # Generate output file path with timestamp
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_path = f"generated_image_{timestamp}.png"
+def generate_with_daemon(prompt, output_path, socket_path=DEFAULT_SOCKET, model_id=MODEL_ID, scheduler=None, steps=None):
+    """Have the daemon on ``socket_path`` generate the image; returns False if no daemon is running.
 
-    # Save the generated image
-    image.save(output_path)
+    A socket that belongs to another user is ignored, as its listener would
+    see the prompt and could answer for the daemon.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return False
+    try:
+        if _owned_by_other_user(socket_path):
+            print(f"Ignoring {socket_path}, which belongs to another user")
+            return False
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+            job = {"prompt": prompt, "output_path": os.path.abspath(output_path), "model_id": model_id,
+                   "scheduler": scheduler, "steps": steps}
+            client.sendall(json.dumps(job).encode() + b"\n")
+            line = client.makefile("rb").readline()
+    except (FileNotFoundError, ConnectionRefusedError):
+        return False
+    if not line:
+        raise RuntimeError("The image generation daemon closed the connection")
+    response = json.loads(line)
+    if "error" in response:
+        raise RuntimeError(f"The image generation daemon failed: {response['error']}")
+    return True
+
+def generate_image(prompt, socket_path=DEFAULT_SOCKET, use_daemon=True, model_id=MODEL_ID, embedding_cache_path=None, cpu_optimize=False,
+                   scheduler=None, steps=None, output_dir=DEFAULT_OUTPUT_DIR, cpu_options=None):
+    # Every image gets a unique path in the output store, and an entry in its index
+    store = OutputStore(output_dir)
+    output_id, output_path = store.allocate()
+
+    if not (use_daemon and generate_with_daemon(prompt, output_path, socket_path, model_id, scheduler, steps)):
+        # No daemon: load the model for this one image
+        pipe = load_pipeline(model_id, device="cpu", cpu_optimize=cpu_optimize, **(cpu_options or {}))
+        embedding_cache = PromptEmbeddingCache(pipe, path=embedding_cache_path)
+        options = scheduled_options(pipe, {"scheduler": scheduler, "num_inference_steps": steps})
+        image = pipe(**embedding_cache.pipeline_inputs(prompt), **options).images[0]
+        image.save(output_path)
+        embedding_cache.save()
+    store.record(output_id, output_path, prompt=prompt, model=model_id, scheduler=scheduler, steps=steps)
     print(f"Image generated and saved as '{output_path}'")
 
+class _JobHandler(socketserver.StreamRequestHandler):
+    # One JSON job per line: generate, save to the client's path, reply with one JSON line
+    def handle(self):
+        for line in self.rfile:
+            job = json.loads(line)
+            try:
+                if job.get("model_id", self.server.model_id) != self.server.model_id:
+                    raise ValueError(f"this daemon serves {self.server.model_id}, not {job['model_id']}")
+                options = scheduled_options(self.server.pipe, {"scheduler": job.get("scheduler"), "num_inference_steps": job.get("steps")})
+                image = self.server.pipe(**self.server.embedding_cache.pipeline_inputs(job["prompt"]), **options).images[0]
+                image.save(job["output_path"])
+                response = {"output_path": job["output_path"]}
+            except Exception as e:
+                response = {"error": str(e)}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+
+def serve(socket_path=DEFAULT_SOCKET, model_id=MODEL_ID, embedding_cache_path=None, cpu_optimize=False, cpu_options=None):
+    """Load the pipeline once and generate images for CLI calls until interrupted.
+
+    Jobs are handled one at a time, in the order they connect. Prompt
+    embeddings are cached, and saved to ``embedding_cache_path`` on shutdown.
+    ``cpu_options`` go to ``optimize_for_cpu`` when ``cpu_optimize`` is set.
+    """
+    if socket_path == DEFAULT_SOCKET:
+        _make_private_dir(RUNTIME_DIR)
+    if os.path.exists(socket_path):
+        if _owned_by_other_user(socket_path):
+            raise SystemExit(f"{socket_path} belongs to another user; remove it or pass --socket")
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.connect(socket_path)
+            raise SystemExit(f"A daemon is already listening on {socket_path}")
+        except ConnectionRefusedError:
+            os.remove(socket_path)  # Left over from a daemon that did not shut down cleanly
+
+    pipe = load_pipeline(model_id, device="cpu", cpu_optimize=cpu_optimize, **(cpu_options or {}))
+    embedding_cache = PromptEmbeddingCache(pipe, path=embedding_cache_path)
+    # Other users must not be able to make this process write files, so the
+    # socket is created owner-only rather than restricted after it is bound
+    umask = os.umask(0o177)
+    try:
+        server = socketserver.UnixStreamServer(socket_path, _JobHandler)
+    finally:
+        os.umask(umask)
+    with server:
+        server.pipe = pipe
+        server.model_id = model_id
+        server.embedding_cache = embedding_cache
+        print(f"Serving {model_id} on {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+            embedding_cache.save()
+            print(f"Prompt embeddings: {embedding_cache.stats()}")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate an image from a text prompt using Stable Diffusion.")
-    parser.add_argument("prompt", type=str, help="The text prompt to generate the image from.")
-    
+    parser.add_argument("prompt", type=str, nargs="?", help="The text prompt to generate the image from.")
+    parser.add_argument("--serve", action="store_true", help="Keep the model loaded and generate images for other CLI calls.")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix socket of the daemon.")
+    parser.add_argument("--no-daemon", action="store_true", help="Always load the model in this process.")
+    parser.add_argument("--embedding-cache", help="File that keeps prompt embeddings between runs.")
+    parser.add_argument("--model", default=MODEL_ID, help="Model to load; 'tiny' is a small random model for testing without downloads.")
+    parser.add_argument("--scheduler", choices=sorted(SCHEDULERS), help="Denoising scheduler; the model's own (PNDM) if omitted.")
+    parser.add_argument("--steps", type=int, help="Number of denoising steps; defaults to the scheduler's usual count.")
+    parser.add_argument("--output-dir", default=DEFAULT_OUTPUT_DIR, help="Output store the image and its metadata are saved in.")
+    parser.add_argument("--cpu-optimize", action="store_true", help="Tune the pipeline for CPU inference (threads, channels-last).")
+    parser.add_argument("--bfloat16", action="store_true", help="With --cpu-optimize, run the UNet under bfloat16 autocast; can be slower, even on CPUs with native bfloat16.")
+    parser.add_argument("--compile-unet", action="store_true", help="With --cpu-optimize, compile the UNet; pays off in the daemon, which keeps it loaded.")
+    parser.add_argument("--attention-slicing", action="store_true", help="With --cpu-optimize, slice attention to save memory at some speed.")
+
     args = parser.parse_args()
-    generate_image(args.prompt)
+    cpu_options = {"bfloat16": args.bfloat16, "compile_unet": args.compile_unet, "attention_slicing": args.attention_slicing}
+    if args.serve:
+        serve(args.socket, args.model, args.embedding_cache, args.cpu_optimize, cpu_options)
+    elif args.prompt is None:
+        parser.error("a prompt is required unless --serve is given")
+    else:
+        generate_image(args.prompt, args.socket, not args.no_daemon, args.model, args.embedding_cache, args.cpu_optimize,
+                       args.scheduler, args.steps, args.output_dir, cpu_options)
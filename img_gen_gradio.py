@@ -1,55 +1,91 @@
 import gradio as gr
-from diffusers import StableDiffusionPipeline
-import torch
-from datetime import datetime
 import asyncio
+import atexit
+import os
 from PIL import Image
 import numpy as np
+from sd_pipeline import (SCHEDULERS, BackgroundLoader, BatchScheduler, ImageWriter, OutputStore, PromptEmbeddingCache, launch_with_warmup,
+                         load_pipeline, tiled_upscale)
 
-# Load the pre-trained Stable Diffusion model
+# The pre-trained Stable Diffusion model
 model_id = "CompVis/stable-diffusion-v1-4"
-device = "cuda" if torch.cuda.is_available() else "cpu"  # Use GPU if available, otherwise CPU
 
-pipe = StableDiffusionPipeline.from_pretrained(model_id)
-pipe = pipe.to(device)
+# Requests from concurrent users with the same settings share batched pipeline calls
+MAX_BATCH_SIZE = 8
+MAX_WAIT_SECONDS = 0.05
+# Our traffic repeats a few hundred templated prompts: their text embeddings are
+# cached, and kept across restarts in the file PROMPT_EMBEDDING_CACHE names, if set
+EMBEDDING_CACHE_PATH = os.environ.get("PROMPT_EMBEDDING_CACHE")
+# Upscaling works on overlapping tiles of the generated image, a few at a time,
+# so large output sizes do not need memory for full-frame intermediates
+UPSCALE_TILE_SIZE = 1024
+UPSCALE_TILE_OVERLAP = 16
+UPSCALE_WORKERS = 2
+# Images are written in the background, so responses do not wait for PNG
+# encoding; anything still queued at shutdown is written before the process exits
+PNG_COMPRESS_LEVEL = 1
+
+def load_scheduler():
+    import torch
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"  # Use GPU if available, otherwise CPU
+    pipe = load_pipeline(model_id, device)
+    embedding_cache = PromptEmbeddingCache(pipe, max_entries=1024, path=EMBEDDING_CACHE_PATH)
+    atexit.register(embedding_cache.save)
+    return BatchScheduler(pipe, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_WAIT_SECONDS, embedding_cache=embedding_cache)
+
+# Loaded in the background once the app is up, so the UI and health checks do not wait for it
+model = BackgroundLoader(load_scheduler, "Stable Diffusion")
+writer = ImageWriter(compress_level=PNG_COMPRESS_LEVEL)
+# Outputs get unique names in sharded directories, indexed by prompt and settings
+store = OutputStore(writer=writer)
+
+async def generate_images(prompt, cycles, width, height, sampler="pndm", steps=0):
+    # All cycles are queued together and generated in batches, with other users' requests
+    # using the same sampler and steps; during warm-up the request waits for the model
+    try:
+        scheduler = await asyncio.to_thread(model.get)
+        generated = await asyncio.to_thread(scheduler.submit, prompt, int(cycles), scheduler=sampler, num_inference_steps=int(steps) or None)
+    except Exception as e:
+        print(f"Error during image generation: {e}")
+        return []
+    print(f"Scheduler: {scheduler.stats()}, prompt embeddings: {scheduler.embedding_cache.stats()}")
 
-async def generate_images(prompt, cycles, width, height):
     images = []
-    for cycle in range(cycles):
+    for cycle, image in enumerate(generated):
         try:
-            # Generate an image
-            result = await asyncio.to_thread(pipe, prompt)
-            image = result.images[0]
-            
             # Upscale the image
             image = upscale_image(image, width, height)
             
-            # Generate output file path with timestamp
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            output_path = f"generated_image_{timestamp}_{cycle}.png"
-            
-            # Save the generated image
-            await asyncio.to_thread(image.save, output_path)
+            # Queue the generated image to be saved; this only waits if the write queue is full
+            await asyncio.to_thread(store.save, image, prompt=prompt, model=model_id, scheduler=sampler, steps=int(steps) or None,
+                                    width=image.width, height=image.height, cycle=cycle)
             
             images.append(image)
         except Exception as e:
-            print(f"Error during image generation or upscaling: {e}")
+            print(f"Error during image upscaling or saving: {e}")
             continue
         
     return images
 
+def resize_tile(tile, size):
+    return tile.resize(size, Image.BICUBIC)
+
 def upscale_image(image, width, height):
     try:
-        # Upscale using bicubic interpolation
-        upscaled_img = image.resize((width, height), Image.BICUBIC)
+        size = (int(width), int(height))
+        if size[0] <= image.width and size[1] <= image.height:
+            return image.resize(size, Image.BICUBIC)
+        # Upscale using bicubic interpolation, tile by tile
+        upscaled_img = tiled_upscale(image, size, resize_tile, UPSCALE_TILE_SIZE, UPSCALE_TILE_OVERLAP, UPSCALE_WORKERS)
         return upscaled_img
     except Exception as e:
         print(f"Error during upscaling: {e}")
         return image
 
-def generate_image_sync(prompt, cycles, width, height):
+def generate_image_sync(prompt, cycles, width, height, sampler, steps):
     # Run the asynchronous function in an event loop
-    return asyncio.run(generate_images(prompt, cycles, width, height))
+    return asyncio.run(generate_images(prompt, cycles, width, height, sampler, steps))
 
 # Create Gradio interface
 iface = gr.Interface(
@@ -59,6 +95,8 @@ iface = gr.Interface(
         gr.Slider(minimum=1, maximum=10, step=1, value=1, label="Number of Cycles"),
         gr.Number(label="Width", value=640),
         gr.Number(label="Height", value=480),
+        gr.Dropdown(choices=sorted(SCHEDULERS), value="pndm", label="Scheduler"),
+        gr.Number(label="Steps (0 for the scheduler's default)", value=0, precision=0),
     ],
     outputs=gr.Gallery(label="Generated Images"),
     title="Text-to-Image Generation with Custom Resolution",
@@ -67,4 +105,5 @@ iface = gr.Interface(
 
 # Launch the web application
 if __name__ == "__main__":
-    iface.launch(share=True)
+    # Let enough requests in at once for the scheduler to fill its batches
+    launch_with_warmup(iface, [model], concurrency_limit=MAX_BATCH_SIZE, share=True)
@@ -0,0 +1,409 @@
+import os
+import sys
+import time
+import argparse
+import csv
+import json
+import subprocess
+import tempfile
+import threading
+import tracemalloc
+import urllib.error
+import urllib.request
+import signal
+import stat
+import numpy as np
+import torch
+from PIL import Image
+from img_gen_cli import generate_image, generate_with_daemon
+from sd_pipeline import (TINY_MODEL_ID, BackgroundLoader, BatchScheduler, max_batch_images, ImageWriter, PromptEmbeddingCache, Stage, bfloat16_supported,
+                         OutputStore, load_pipeline, optimize_for_cpu, scheduled_options, tiled_upscale, tiny_pipeline)
+
+def count_text_encoder_calls(pipe):
+    # Returns a list that grows by one on every text encoder forward pass
+    calls = []
+    pipe.text_encoder.register_forward_hook(lambda *_: calls.append(1))
+    return calls
+
+def check_embedding_cache(prompt="a lighthouse on a cliff at dusk", steps=2):
+    """Check that a cached prompt skips the text encoder and gives the same image."""
+    pipe = tiny_pipeline()
+    calls = count_text_encoder_calls(pipe)
+    cache = PromptEmbeddingCache(pipe)
+
+    direct = pipe(prompt, num_inference_steps=steps, output_type="np", generator=torch.manual_seed(0)).images
+    assert len(calls) == 2, f"Expected the prompt and the empty negative prompt to be encoded, got {len(calls)} calls"
+
+    calls.clear()
+    first = pipe(**cache.pipeline_inputs(prompt), num_inference_steps=steps, output_type="np", generator=torch.manual_seed(0)).images
+    misses = len(calls)
+    cached = pipe(**cache.pipeline_inputs(prompt), num_inference_steps=steps, output_type="np", generator=torch.manual_seed(0)).images
+    print(f"Embedding cache: {misses} encoder calls on a miss, {len(calls) - misses} on a hit, {cache.stats()}")
+    assert len(calls) == misses, "The text encoder ran for a cached prompt"
+    assert abs(direct - first).max() < 1e-5 and abs(first - cached).max() == 0, "Cached embeddings changed the image"
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "prompt_embeddings.pt")
+        cache.path = path
+        cache.save()
+        calls.clear()
+        PromptEmbeddingCache(pipe, path=path).pipeline_inputs(prompt)
+        assert not calls, "The text encoder ran for a prompt saved by an earlier cache"
+        assert os.listdir(tmp_dir) == ["prompt_embeddings.pt"], f"Saving left temporary files: {os.listdir(tmp_dir)}"
+
+        # A truncated file, e.g. from a crash in an older version, must not stop the app from loading
+        with open(path, "r+b") as file:
+            file.truncate(os.path.getsize(path) // 2)
+        assert not PromptEmbeddingCache(pipe, path=path).entries, "A truncated cache file was loaded"
+    print("Embedding cache: reloaded after a restart, truncated file ignored")
+
+def seconds_per_step(pipe, prompt="a lighthouse on a cliff at dusk", steps=10):
+    """Seconds per denoising step, after a warm-up call that pays for any compilation."""
+    step_ends = []
+
+    def record(pipe, step, timestep, callback_kwargs):
+        step_ends.append(time.perf_counter())
+        return callback_kwargs
+
+    pipe(prompt, num_inference_steps=steps, output_type="np")
+    pipe(prompt, num_inference_steps=steps, output_type="np", callback_on_step_end=record)
+    # The first step also encodes the prompt, so time from its end
+    return (step_ends[-1] - step_ends[0]) / (len(step_ends) - 1)
+
+def benchmark_cpu_profile(steps=20, repeats=3, tolerance=1.1):
+    """Compare seconds per step of the tiny model untuned, with optimize_for_cpu, and with each of its opt-in options.
+
+    Each figure is the best of ``repeats`` runs. optimize_for_cpu's defaults
+    must not be slower than no tuning (within ``tolerance``, for noise).
+    """
+    def best_seconds_per_step(pipe):
+        return min(seconds_per_step(pipe, steps=steps) for _ in range(repeats))
+
+    default = best_seconds_per_step(tiny_pipeline())
+    print(f"CPU profile: untuned {default * 1000:.1f} ms/step ({torch.get_num_threads()} threads)")
+    profiles = {"optimize_for_cpu defaults": {}, "+ compile_unet": {"compile_unet": True}, "+ attention_slicing": {"attention_slicing": True}}
+    if bfloat16_supported():
+        profiles["+ bfloat16"] = {"bfloat16": True}
+    for label, options in profiles.items():
+        optimized = best_seconds_per_step(optimize_for_cpu(tiny_pipeline(), **options))
+        print(f"CPU profile: {label} {optimized * 1000:.1f} ms/step ({torch.get_num_threads()} threads), {default / optimized:.2f}x")
+        if not options:
+            assert optimized <= default * tolerance, f"optimize_for_cpu's defaults are slower than no tuning: {optimized:.3f} > {default:.3f} s/step"
+
+def benchmark_batching(num_images=4, steps=10, prompt="a lighthouse on a cliff at dusk"):
+    """Compare one request for ``num_images`` images, run by BatchScheduler, with as many single-image calls.
+
+    The default memory budget must let such a request run as one pipeline
+    call at 512x512, as the apps generate.
+    """
+    assert max_batch_images(512, 512) >= num_images, f"The default memory budget splits {num_images} images at 512x512 into several calls"
+    pipe = tiny_pipeline()
+    pipe(prompt, num_inference_steps=steps)  # Warm-up
+    start = time.perf_counter()
+    for _ in range(num_images):
+        pipe(prompt, num_inference_steps=steps)
+    single_seconds = time.perf_counter() - start
+
+    scheduler = BatchScheduler(pipe, max_batch_size=num_images)
+    start = time.perf_counter()
+    images = scheduler.submit(prompt, num_images, num_inference_steps=steps)
+    batch_seconds = time.perf_counter() - start
+    print(f"Batching: {num_images} single calls {single_seconds:.2f}s, one request of {num_images} {batch_seconds:.2f}s "
+          f"({single_seconds / batch_seconds:.2f}x), batch sizes {scheduler.stats()['batch_sizes']}")
+    assert len(images) == num_images and scheduler.stats()["batch_sizes"] == {num_images: 1}, "The request was not generated in one call"
+
+def check_coalescing(num_requests=4, steps=2, prompt="a lighthouse on a cliff at dusk"):
+    """Check that concurrent single-image requests share one pipeline call, and that /health reports it."""
+    scheduler = BatchScheduler(tiny_pipeline(), max_batch_size=num_requests, max_wait=1.0)
+    loader = BackgroundLoader(lambda: scheduler, "Stable Diffusion")
+    loader.get()
+
+    results = {}
+    def request(i):
+        results[i] = scheduler.submit(f"{prompt}, variation {i}", num_inference_steps=steps)
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(num_requests)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = json.loads(json.dumps(loader.status()))["stats"]  # As served by /health
+    print(f"Coalescing: {num_requests} concurrent requests, /health stats {stats}")
+    assert len(results) == num_requests and all(len(images) == 1 for images in results.values())
+    assert stats["batch_sizes"] == {str(num_requests): 1}, "Concurrent requests were not merged into one pipeline call"
+    assert stats["queue_depth"] == 0
+
+def check_restore_stage(num_images=8, steps=10):
+    """Check that generation keeps going while a stub restore stage works on earlier images.
+
+    The stub takes as long as generating an image, so running the two stages
+    back to back should take about twice as long as pipelining them.
+    """
+    scheduler = BatchScheduler(tiny_pipeline(), max_batch_size=1, max_wait=0)
+
+    def generate(prompt):
+        return scheduler.submit(prompt, num_inference_steps=steps)[0]
+
+    started = time.perf_counter()
+    generate("warm up")
+    restore_seconds = time.perf_counter() - started
+
+    def restore(image):
+        time.sleep(restore_seconds)
+        return image
+
+    started = time.perf_counter()
+    for index in range(num_images):
+        restore(generate(f"prompt {index}"))
+    sequential = time.perf_counter() - started
+
+    restore_stage = Stage(restore, workers=1, max_queue=2, name="restore")
+    started = time.perf_counter()
+    futures = [restore_stage.submit(generate(f"prompt {index}")) for index in range(num_images)]
+    for future in futures:
+        future.result()
+    pipelined = time.perf_counter() - started
+    print(f"Restore stage: {num_images} images in {sequential:.2f}s back to back, {pipelined:.2f}s pipelined; "
+          f"generation {scheduler.stats()['seconds_per_image']:.3f}s per image, restore {restore_stage.stats()}")
+    assert pipelined < 0.8 * sequential, "Generation waited for the restore stage"
+
+def check_tiled_upscale(scales=(4, 8), tile_size=512, overlap=16):
+    """Check that tiled bicubic upscaling matches a full-frame resize, with working memory independent of the output size."""
+    rng = np.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 256, (64, 64, 3), dtype=np.uint8)).resize((512, 512), Image.BICUBIC)
+
+    def resize_tile(tile, size):
+        return tile.resize(size, Image.BICUBIC)
+
+    working = []
+    for scale in scales:
+        size = (image.width * scale, image.height * scale)
+        tracemalloc.start()
+        started = time.perf_counter()
+        tiled = tiled_upscale(image, size, resize_tile, tile_size, overlap)
+        seconds = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # The output array itself grows with the size; everything else should not
+        working.append(peak - size[0] * size[1] * 3)
+        difference = np.abs(np.asarray(tiled, np.int16) - np.asarray(image.resize(size, Image.BICUBIC), np.int16))
+        print(f"Tiled upscale to {size[0]}x{size[1]}: {seconds:.2f}s, {working[-1] / 1e6:.1f} MB besides the output, "
+              f"max difference from a full-frame resize {difference.max()}")
+        assert difference.max() <= 4, "Tile seams are visible"
+    assert max(working) < 2 * min(working), "Working memory grew with the output size"
+
+def benchmark_writes(size=2048, count=4):
+    """Compare the time a request spends saving ``count`` PNGs inline with queueing them on an ImageWriter."""
+    rng = np.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 256, (64, 64, 3), dtype=np.uint8)).resize((size, size), Image.BICUBIC)
+    with tempfile.TemporaryDirectory() as out_dir:
+        started = time.perf_counter()
+        for index in range(count):
+            image.save(os.path.join(out_dir, f"inline_{index}.png"))
+        inline = (time.perf_counter() - started) / count
+        print(f"Writes: inline at the default compression, {inline * 1000:.0f} ms per image in the request, "
+              f"{os.path.getsize(os.path.join(out_dir, 'inline_0.png')) / 1e6:.1f} MB")
+        for compress_level in (6, 1):
+            writer = ImageWriter(compress_level=compress_level)
+            started = time.perf_counter()
+            for index in range(count):
+                writer.save(image, os.path.join(out_dir, f"queued_{compress_level}_{index}.png"))
+            queued = (time.perf_counter() - started) / count
+            writer.join()
+            written = (time.perf_counter() - started) / count
+            print(f"Writes: queued at compress_level={compress_level}, {queued * 1000:.1f} ms per image in the request, "
+                  f"{written * 1000:.0f} ms per image in the background, "
+                  f"{os.path.getsize(os.path.join(out_dir, f'queued_{compress_level}_0.png')) / 1e6:.1f} MB")
+
+def _box_mean(x, size):
+    # Mean of every size x size window, from 2D cumulative sums
+    sums = np.pad(x, ((1, 0), (1, 0), (0, 0))).cumsum(0).cumsum(1)
+    return (sums[size:, size:] - sums[:-size, size:] - sums[size:, :-size] + sums[:-size, :-size]) / size ** 2
+
+def ssim(a, b, size=7):
+    """Mean structural similarity of two HxWxC float images in [0, 1], over size x size windows."""
+    a, b = a.astype(np.float64), b.astype(np.float64)
+    c1, c2 = 0.01 ** 2, 0.03 ** 2
+    mean_a, mean_b = _box_mean(a, size), _box_mean(b, size)
+    var_a = _box_mean(a * a, size) - mean_a ** 2
+    var_b = _box_mean(b * b, size) - mean_b ** 2
+    covariance = _box_mean(a * b, size) - mean_a * mean_b
+    similarity = ((2 * mean_a * mean_b + c1) * (2 * covariance + c2)) / ((mean_a ** 2 + mean_b ** 2 + c1) * (var_a + var_b + c2))
+    return float(similarity.mean())
+
+# (scheduler, steps) pairs compared against the model's default of PNDM with 50 steps
+SCHEDULER_SETTINGS = [("pndm", 50), ("pndm", 25), ("dpm++", 25), ("dpm++", 20), ("dpm++", 12),
+                      ("euler", 30), ("euler", 20), ("euler-a", 20), ("lcm", 4)]
+
+def benchmark_schedulers(pipe, prompt="a lighthouse on a cliff at dusk", settings=SCHEDULER_SETTINGS, reference=("pndm", 50), seed=0):
+    """Seconds per image and SSIM against the ``reference`` setting, for each (scheduler, steps) pair.
+
+    Every image starts from the same seed, so the SSIM measures how far the
+    faster setting drifts from the reference image.
+    """
+    def generate(name, steps):
+        options = scheduled_options(pipe, {"scheduler": name, "num_inference_steps": steps})
+        started = time.perf_counter()
+        image = pipe(prompt, output_type="np", generator=torch.manual_seed(seed), **options).images[0]
+        return image, time.perf_counter() - started
+
+    generate(*reference)
+    target, _ = generate(*reference)
+    results = []
+    for name, steps in settings:
+        image, seconds = generate(name, steps)
+        results.append({"scheduler": name, "steps": steps, "seconds_per_image": seconds, "ssim": ssim(target, image)})
+        print(f"Scheduler {name:8} {steps:3d} steps: {seconds:.2f}s per image, SSIM {results[-1]['ssim']:.3f}")
+    return results
+
+def check_daemon(prompt="a lighthouse on a cliff at dusk", steps=2, timeout=300):
+    """Check a CLI call through a tiny-model daemon, and the fallback when no daemon is listening."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "img_gen_cli.py")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        socket_path = os.path.join(tmp_dir, "daemon.sock")
+        daemon = subprocess.Popen([sys.executable, script, "--serve", "--model", TINY_MODEL_ID, "--socket", socket_path],
+                                  stdout=subprocess.DEVNULL)
+        try:
+            started = time.perf_counter()
+            while not os.path.exists(socket_path):
+                assert daemon.poll() is None, "The daemon exited before listening"
+                assert time.perf_counter() - started < timeout, "The daemon did not start listening"
+                time.sleep(0.1)
+            mode = stat.S_IMODE(os.stat(socket_path).st_mode)
+            assert mode == 0o600, f"The daemon socket is accessible to other users (mode {mode:o})"
+
+            start = time.perf_counter()
+            assert generate_with_daemon(prompt, os.path.join(tmp_dir, "direct.png"), socket_path, TINY_MODEL_ID, steps=steps)
+            generate_image(prompt, socket_path, model_id=TINY_MODEL_ID, steps=steps, output_dir=tmp_dir)
+            daemon_seconds = time.perf_counter() - start
+        finally:
+            daemon.send_signal(signal.SIGINT)
+            daemon.wait(timeout)
+        assert not os.path.exists(socket_path), "The daemon left its socket behind"
+
+        # No daemon listening now: the CLI loads the model itself
+        assert not generate_with_daemon(prompt, os.path.join(tmp_dir, "unused.png"), socket_path, TINY_MODEL_ID, steps=steps)
+        start = time.perf_counter()
+        generate_image(prompt, socket_path, model_id=TINY_MODEL_ID, steps=steps, output_dir=tmp_dir)
+        fallback_seconds = time.perf_counter() - start
+
+        entries = OutputStore(tmp_dir).find(prompt=prompt)
+        assert len(entries) == 2 and all(Image.open(entry["path"]).size for entry in entries), "Generated images are missing from the output store"
+        assert os.path.exists(os.path.join(tmp_dir, "direct.png"))
+    print(f"Daemon: 2 images in {daemon_seconds:.2f}s through the socket, fallback without it {fallback_seconds:.2f}s")
+
+def _http_status(url):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+def measure_startup(script, port=7861, wait_ready=False, timeout=900):
+    """Seconds from launching a Gradio app until it answers HTTP, and until /health reports ready.
+
+    The ready time is None unless ``wait_ready`` is set, as it includes
+    loading the real models.
+    """
+    env = dict(os.environ, GRADIO_SERVER_PORT=str(port))
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, script], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    listening = ready = None
+    try:
+        while time.perf_counter() - started < timeout and process.poll() is None:
+            if listening is None and _http_status(f"http://127.0.0.1:{port}/") == 200:
+                listening = time.perf_counter() - started
+                if not wait_ready:
+                    break
+            if listening is not None and _http_status(f"http://127.0.0.1:{port}/health") == 200:
+                ready = time.perf_counter() - started
+                break
+            time.sleep(0.1)
+    finally:
+        process.terminate()
+        process.wait()
+    return listening, ready
+
+SHUTDOWN_APP = """
+import sys, time
+import gradio as gr
+from PIL import Image
+from sd_pipeline import BackgroundLoader, ImageWriter, launch_with_warmup
+
+class SlowImage:
+    # Takes a while to encode, so the write is still queued when SIGTERM arrives
+    def save(self, path, **options):
+        time.sleep(2)
+        Image.new("RGB", (8, 8)).save(path, **options)
+
+writer = ImageWriter()
+loader = BackgroundLoader(lambda: writer.save(SlowImage(), sys.argv[1]), "writer")
+launch_with_warmup(gr.Interface(lambda text: text, "text", "text", title="shutdown"), [loader])
+"""
+
+def check_sigterm_flush(port=7862, timeout=120):
+    """Check that SIGTERM to an app served by launch_with_warmup still writes the images it has queued."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        script, output_path = os.path.join(tmp_dir, "app.py"), os.path.join(tmp_dir, "queued.png")
+        with open(script, "w") as file:
+            file.write(SHUTDOWN_APP)
+        env = dict(os.environ, GRADIO_SERVER_PORT=str(port), PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        process = subprocess.Popen([sys.executable, script, output_path], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            started = time.perf_counter()
+            while _http_status(f"http://127.0.0.1:{port}/health") != 200:
+                assert process.poll() is None and time.perf_counter() - started < timeout, "The app did not become ready"
+                time.sleep(0.1)
+        finally:
+            process.terminate()
+            returncode = process.wait(timeout)
+        assert os.path.exists(output_path), "An image queued before SIGTERM was not written"
+    print(f"SIGTERM: queued image written, exit status {returncode}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks and checks for the Stable Diffusion helpers, on a tiny random model.")
+    parser.add_argument("checks", nargs="*", choices=["embeddings", "cpu", "batching", "coalescing", "schedulers", "restore", "tiles", "writes", "daemon", "sigterm", "startup"], help="What to run; everything if omitted.")
+    parser.add_argument("--wait-ready", action="store_true", help="Also time the apps until their models are loaded.")
+    parser.add_argument("--model", default=TINY_MODEL_ID,
+                        help="Model for the scheduler benchmark; the tiny random model only measures speed, use a real one to judge quality.")
+    parser.add_argument("--csv", help="Write the scheduler benchmark results to this CSV file.")
+    args = parser.parse_args()
+    checks = args.checks or ["embeddings", "cpu", "batching", "coalescing", "schedulers", "restore", "tiles", "writes", "daemon", "sigterm", "startup"]
+
+    if "embeddings" in checks:
+        check_embedding_cache()
+    if "cpu" in checks:
+        benchmark_cpu_profile()
+    if "batching" in checks:
+        benchmark_batching()
+    if "coalescing" in checks:
+        check_coalescing()
+    if "schedulers" in checks:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        results = benchmark_schedulers(load_pipeline(args.model, device))
+        if args.csv:
+            with open(args.csv, "w", newline="") as file:
+                writer = csv.DictWriter(file, fieldnames=list(results[0]))
+                writer.writeheader()
+                writer.writerows(results)
+    if "restore" in checks:
+        check_restore_stage()
+    if "tiles" in checks:
+        check_tiled_upscale()
+    if "writes" in checks:
+        benchmark_writes()
+    if "daemon" in checks:
+        check_daemon()
+    if "sigterm" in checks:
+        check_sigterm_flush()
+    if "startup" in checks:
+        for script in ("img_gen_gradio.py", "StabDiff1.5.py"):
+            listening, ready = measure_startup(os.path.join(os.path.dirname(os.path.abspath(__file__)), script), wait_ready=args.wait_ready)
+            listening_text = f"{listening:.1f}s" if listening is not None else "did not start"
+            ready_text = f", ready after {ready:.1f}s" if ready is not None else ""
+            print(f"{script}: listening after {listening_text}{ready_text}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,659 @@
+# Shared Stable Diffusion loading for the image generation scripts.
+# torch and diffusers are imported where they are needed, so an app can start
+# serving while they load in the background (see BackgroundLoader).
+
+import atexit
+import json
+import os
+import queue
+import signal
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+MODEL_ID = "CompVis/stable-diffusion-v1-4"
+
+# Model id that loads tiny_pipeline() instead of downloaded weights
+TINY_MODEL_ID = "tiny"
+
+def load_pipeline(model_id=MODEL_ID, device="cpu", cpu_optimize=False, **cpu_options):
+    """Load ``model_id`` onto ``device``; with ``cpu_optimize``, tune it with ``optimize_for_cpu(pipe, **cpu_options)``."""
+    from diffusers import StableDiffusionPipeline
+
+    if model_id == TINY_MODEL_ID:
+        pipe = tiny_pipeline()
+    else:
+        pipe = StableDiffusionPipeline.from_pretrained(model_id)
+    pipe = pipe.to(device)
+    if cpu_optimize:
+        optimize_for_cpu(pipe, **cpu_options)
+    return pipe
+
+def bfloat16_supported():
+    """Whether this CPU has native bfloat16 instructions (AVX512-BF16 or AMX)."""
+    import torch
+
+    is_supported = getattr(torch.ops.mkldnn, "_is_mkldnn_bf16_supported", None)
+    return torch.backends.mkldnn.is_available() and is_supported is not None and is_supported()
+
+def _bfloat16_forward(forward):
+    # Runs the UNet under bfloat16 autocast, and hands the noise prediction
+    # back in the latents' dtype so the scheduler keeps working in fp32
+    import torch
+
+    def run(sample, *args, **kwargs):
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            output = forward(sample, *args, **kwargs)
+        if isinstance(output, tuple):
+            return (output[0].to(sample.dtype),) + output[1:]
+        output.sample = output.sample.to(sample.dtype)
+        return output
+    return run
+
+def optimize_for_cpu(pipe, threads=None, bfloat16=False, compile_unet=False, attention_slicing=False):
+    """Tune a pipeline for CPU inference, in place; returns ``pipe``.
+
+    Sets the intra-op thread count (by default, every CPU this process may
+    use) and converts the UNet and VAE to channels-last. The rest is opt-in,
+    as it can be slower than no tuning at all: ``bfloat16`` runs the UNet
+    under bfloat16 autocast (only a gain with native bfloat16, see
+    ``bfloat16_supported``, and not always then), ``compile_unet`` compiles
+    the UNet on its first call, which only pays off in processes that keep the
+    pipeline loaded, and ``attention_slicing`` saves memory at some speed.
+    """
+    import torch
+
+    if threads is None:
+        threads = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    torch.set_num_threads(threads)
+    pipe.unet.to(memory_format=torch.channels_last)
+    pipe.vae.to(memory_format=torch.channels_last)
+    if attention_slicing:
+        pipe.enable_attention_slicing()
+    if bfloat16:
+        pipe.unet.forward = _bfloat16_forward(pipe.unet.forward)
+    if compile_unet and hasattr(torch, "compile"):
+        pipe.unet = torch.compile(pipe.unet)
+    return pipe
+
+# Denoising schedulers the scripts can switch between: diffusers class, its
+# options, and the step count it is usually run at. "lcm" only gives good
+# images with LCM-distilled weights (or an LCM-LoRA); with plain weights it
+# marks the latency floor
+SCHEDULERS = {
+    "pndm": ("PNDMScheduler", {}, 50),
+    "dpm++": ("DPMSolverMultistepScheduler", {"algorithm_type": "dpmsolver++"}, 20),
+    "euler": ("EulerDiscreteScheduler", {}, 30),
+    "euler-a": ("EulerAncestralDiscreteScheduler", {}, 30),
+    "lcm": ("LCMScheduler", {}, 4),
+}
+
+def use_scheduler(pipe, name):
+    """Switch ``pipe`` to the scheduler ``name`` from SCHEDULERS; returns that scheduler's usual step count."""
+    import diffusers
+
+    class_name, scheduler_options, steps = SCHEDULERS[name]
+    # Every scheduler is built from the model's own scheduler config, so
+    # switching back and forth does not lose its settings
+    if not hasattr(pipe, "base_scheduler_config"):
+        pipe.base_scheduler_config = pipe.scheduler.config
+    if type(pipe.scheduler).__name__ != class_name:
+        pipe.scheduler = getattr(diffusers, class_name).from_config(pipe.base_scheduler_config, **scheduler_options)
+    return steps
+
+def scheduled_options(pipe, options):
+    """Apply the ``scheduler`` option to ``pipe`` and return the remaining pipeline options.
+
+    A ``num_inference_steps`` of None is dropped, or replaced by the chosen
+    scheduler's usual step count.
+    """
+    options = dict(options)
+    name = options.pop("scheduler", None)
+    steps = use_scheduler(pipe, name) if name is not None else None
+    if options.get("num_inference_steps") is None:
+        options.pop("num_inference_steps", None)
+        if steps is not None:
+            options["num_inference_steps"] = steps
+    return options
+
+# Rough peak memory of one image in a batched call, per latent pixel: UNet
+# activations with classifier-free guidance in fp32, about 1.2 GB at 512x512
+BYTES_PER_LATENT_PIXEL = 300_000
+# The default budget lets a request for 4 images at 512x512 run as one call (about 4.9 GB)
+DEFAULT_MEMORY_BUDGET = 4 * (512 // 8) * (512 // 8) * BYTES_PER_LATENT_PIXEL
+
+def max_batch_images(height=512, width=512, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """Largest batch whose estimated peak memory fits in ``memory_budget`` (at least 1)."""
+    per_image = (height // 8) * (width // 8) * BYTES_PER_LATENT_PIXEL
+    return max(1, memory_budget // per_image)
+
+def output_size(pipe, options):
+    """Height and width the pipeline will generate with ``options``."""
+    default_size = pipe.unet.config.sample_size * pipe.vae_scale_factor
+    return options.get("height") or default_size, options.get("width") or default_size
+
+class PromptEmbeddingCache:
+    """LRU cache of CLIP text embeddings for prompts and negative prompts.
+
+    ``pipeline_inputs`` turns prompts into the ``prompt_embeds`` and
+    ``negative_prompt_embeds`` pipeline arguments, so the text encoder only
+    runs for prompts not seen before. With a ``path`` the cache is loaded from
+    it if present and ``save`` writes it back, keeping it across restarts. A
+    file that cannot be loaded is reported and ignored, starting empty.
+    """
+
+    def __init__(self, pipe, max_entries=512, path=None):
+        self.pipe = pipe
+        self.max_entries = max_entries
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            import torch
+
+            try:
+                saved = torch.load(path, map_location="cpu")
+                # Embeddings are only valid for the text encoder that produced them
+                if saved["model"] == pipe.name_or_path:
+                    for prompt, embedding in list(saved["embeddings"].items())[-max_entries:]:
+                        self.entries[prompt] = embedding.to(pipe.device)
+            except Exception as e:
+                # Truncated or from an incompatible version: the cache only saves time, so do without it
+                print(f"Ignoring the prompt embedding cache {path}: {e}")
+                self.entries.clear()
+
+    def get(self, prompt):
+        """Embedding of one prompt, shaped (1, tokens, hidden size)."""
+        with self.lock:
+            if prompt in self.entries:
+                self.entries.move_to_end(prompt)
+                self.hits += 1
+                return self.entries[prompt]
+            self.misses += 1
+        import torch
+
+        with torch.no_grad():
+            embedding, _ = self.pipe.encode_prompt(prompt, self.pipe.device, 1, False)
+        with self.lock:
+            self.entries[prompt] = embedding
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return embedding
+
+    def pipeline_inputs(self, prompts, negative_prompt=""):
+        """Pipeline arguments for one prompt or a list of prompts, all with ``negative_prompt``.
+
+        The negative embeddings are passed too, even for the default empty
+        negative prompt, as the pipeline would otherwise encode it every call.
+        """
+        import torch
+
+        prompts = [prompts] if isinstance(prompts, str) else list(prompts)
+        negative = self.get(negative_prompt or "")
+        return {"prompt_embeds": torch.cat([self.get(prompt) for prompt in prompts]),
+                "negative_prompt_embeds": torch.cat([negative] * len(prompts))}
+
+    def save(self):
+        if self.path is None:
+            return
+        import torch
+
+        with self.lock:
+            embeddings = {prompt: embedding.cpu() for prompt, embedding in self.entries.items()}
+        # Write under a temporary name, so a process killed mid-save leaves the old file intact
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        torch.save({"model": self.pipe.name_or_path, "embeddings": embeddings}, temp_path)
+        os.replace(temp_path, self.path)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries),
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+class BatchScheduler:
+    """Coalesce concurrent generation requests into batched pipeline calls.
+
+    ``submit`` queues the images of one request and blocks until they are
+    ready. A worker thread takes the oldest queued image, waits up to
+    ``max_wait`` seconds for more with the same options (resolution, step
+    count, ...), and generates them in one pipeline call with a list of
+    prompts, so every denoising step runs the UNet once for all callers. A
+    batch holds at most ``max_batch_size`` images, and no more than fit in
+    ``memory_budget`` at its resolution. A ``scheduler`` option switches the
+    pipeline's scheduler for that batch (see scheduled_options). With an
+    ``embedding_cache`` prompts are passed to the pipeline as cached
+    embeddings.
+    """
+
+    def __init__(self, pipe, max_batch_size=8, max_wait=0.05, memory_budget=DEFAULT_MEMORY_BUDGET, embedding_cache=None):
+        self.pipe = pipe
+        self.embedding_cache = embedding_cache
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.memory_budget = memory_budget
+        self.pending = []
+        self.condition = threading.Condition()
+        self.batch_sizes = Counter()
+        self.busy_seconds = 0.0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, prompt, num_images=1, **options):
+        """Generate ``num_images`` images of ``prompt``; ``options`` go to the pipeline."""
+        key = tuple(sorted(options.items()))
+        futures = [Future() for _ in range(num_images)]
+        with self.condition:
+            now = time.monotonic()
+            self.pending.extend((now, key, prompt, options, future) for future in futures)
+            self.condition.notify()
+        return [future.result() for future in futures]
+
+    def _batch_limit(self, options):
+        height, width = output_size(self.pipe, options)
+        return min(self.max_batch_size, max_batch_images(height, width, self.memory_budget))
+
+    def _next_batch(self):
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            arrival, key, _, options, _ = self.pending[0]
+            limit = self._batch_limit(options)
+            while True:
+                batch = [request for request in self.pending if request[1] == key][:limit]
+                remaining = arrival + self.max_wait - time.monotonic()
+                if len(batch) == limit or remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            for request in batch:
+                self.pending.remove(request)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            self.batch_sizes[len(batch)] += 1
+            prompts = [request[2] for request in batch]
+            started = time.perf_counter()
+            try:
+                options = scheduled_options(self.pipe, batch[0][3])
+                if self.embedding_cache is not None:
+                    inputs = self.embedding_cache.pipeline_inputs(prompts, options.pop("negative_prompt", ""))
+                    images = self.pipe(**inputs, **options).images
+                else:
+                    images = self.pipe(prompts, **options).images
+            except Exception as e:
+                for request in batch:
+                    request[4].set_exception(e)
+                continue
+            finally:
+                with self.condition:
+                    self.busy_seconds += time.perf_counter() - started
+            for request, image in zip(batch, images):
+                request[4].set_result(image)
+
+    def stats(self):
+        """Queue depth, how many batches of each size have run, and the time spent generating."""
+        with self.condition:
+            batches = sum(self.batch_sizes.values())
+            images = sum(size * count for size, count in self.batch_sizes.items())
+            return {"queue_depth": len(self.pending), "batches": batches, "images": images,
+                    "mean_batch_size": images / batches if batches else 0.0,
+                    "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                    "busy_seconds": self.busy_seconds,
+                    "seconds_per_image": self.busy_seconds / images if images else 0.0}
+
+class Stage:
+    """One stage of an image pipeline: ``workers`` threads apply ``process`` to queued items.
+
+    ``submit`` returns a Future for the processed item. At most ``max_queue``
+    items wait for a worker; beyond that ``submit`` blocks, holding back the
+    stage that feeds this one instead of letting images pile up in memory.
+    ``process`` is a plain attribute, so a test can replace it with a stub.
+    """
+
+    def __init__(self, process, workers=1, max_queue=8, name="stage"):
+        self.process = process
+        self.name = name
+        self.queue = queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        for _ in range(workers):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, item):
+        future = Future()
+        self.queue.put((time.perf_counter(), item, future))
+        return future
+
+    def _run(self):
+        while True:
+            queued, item, future = self.queue.get()
+            started = time.perf_counter()
+            try:
+                future.set_result(self.process(item))
+            except Exception as e:
+                future.set_exception(e)
+            with self.lock:
+                self.items += 1
+                self.wait_seconds += started - queued
+                self.busy_seconds += time.perf_counter() - started
+            self.queue.task_done()
+
+    def join(self):
+        """Wait until every submitted item has been processed."""
+        self.queue.join()
+
+    def stats(self):
+        """Queue depth, items processed, and mean seconds queued and processing per item."""
+        with self.lock:
+            return {"name": self.name, "queue_depth": self.queue.qsize(), "items": self.items,
+                    "busy_seconds": self.busy_seconds,
+                    "mean_wait_seconds": self.wait_seconds / self.items if self.items else 0.0,
+                    "mean_seconds": self.busy_seconds / self.items if self.items else 0.0}
+
+class ImageWriter(Stage):
+    """Stage that encodes and writes images in the background, off the request path.
+
+    ``save(image, path)`` returns at once unless ``max_queue`` images are
+    already waiting. PNGs are written at ``compress_level`` (0-9; Pillow's
+    default is 6, while 1 encodes several times faster for somewhat larger
+    files). Everything queued is written before the interpreter exits (apps
+    served by ``launch_with_warmup`` also exit this way on SIGTERM), and
+    ``join`` waits for it explicitly. Nobody waits on a write, so errors are
+    printed.
+    """
+
+    def __init__(self, compress_level=1, workers=1, max_queue=16):
+        super().__init__(self._write, workers, max_queue, name="write")
+        self.compress_level = compress_level
+        atexit.register(self.join)
+
+    def _write(self, item):
+        image, path = item
+        image.save(path, compress_level=self.compress_level)
+        return path
+
+    def save(self, image, path):
+        """Queue ``image`` to be written to ``path``; returns a Future for the path."""
+        def report(future):
+            if future.exception() is not None:
+                print(f"Error saving {path}: {future.exception()}")
+
+        future = self.submit((image, path))
+        future.add_done_callback(report)
+        return future
+
+DEFAULT_OUTPUT_DIR = "outputs"
+
+class OutputStore:
+    """Generated images under ``root``, with a metadata index.
+
+    Every image gets a random UUID as its name, so two requests can never
+    overwrite each other. Images go into two levels of sub-directories named
+    after the UUID's first characters (``root/3f/a2/3fa2....png``), so no
+    directory grows past a few thousand files. ``root/index.jsonl`` holds
+    one JSON line per image, with its id, path relative to ``root``, creation
+    time and whatever metadata the generator passed (prompt, settings, ...).
+    ``find`` searches it without listing any directory. With a ``writer`` the
+    images are written in the background; their index entry may then appear
+    before the file is complete.
+    """
+
+    def __init__(self, root=DEFAULT_OUTPUT_DIR, writer=None):
+        self.root = root
+        self.writer = writer
+        self.index_path = os.path.join(root, "index.jsonl")
+        self.lock = threading.Lock()
+
+    def allocate(self, extension=".png"):
+        """A new id and the path its file goes to, with the directories created."""
+        output_id = uuid.uuid4().hex
+        path = os.path.join(self.root, output_id[:2], output_id[2:4], output_id + extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return output_id, path
+
+    def record(self, output_id, path, **metadata):
+        """Add the file at ``path`` to the index."""
+        entry = {"id": output_id, "path": os.path.relpath(path, self.root), "created": time.time(), **metadata}
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        # One append per entry, so processes sharing the store do not interleave lines
+        with self.lock, open(self.index_path, "a", encoding="utf-8") as index:
+            index.write(line)
+
+    def save(self, image, **metadata):
+        """Store ``image`` and index it with ``metadata``; returns its id and path."""
+        output_id, path = self.allocate()
+        if self.writer is not None:
+            self.writer.save(image, path)
+        else:
+            image.save(path)
+        self.record(output_id, path, **metadata)
+        return output_id, path
+
+    def find(self, **criteria):
+        """Index entries whose fields equal ``criteria``, oldest first, with ``path`` made absolute."""
+        if not os.path.exists(self.index_path):
+            return []
+        with open(self.index_path, encoding="utf-8") as index:
+            entries = [json.loads(line) for line in index if line.strip()]
+        matches = [entry for entry in entries if all(entry.get(key) == value for key, value in criteria.items())]
+        for entry in matches:
+            entry["path"] = os.path.abspath(os.path.join(self.root, entry["path"]))
+        return matches
+
+class BackgroundLoader:
+    """Run ``load()`` on a background thread and hand out its result once it is ready.
+
+    ``get`` starts the load if needed and blocks until it has finished, so
+    requests arriving during warm-up wait for the model instead of failing.
+    ``status`` reports the state ("idle", "loading", "ready" or "failed") for
+    health checks and the UI, and once loaded the ``stats()`` of a value that
+    has them, such as a BatchScheduler's queue depth and batch sizes.
+    """
+
+    def __init__(self, load, name):
+        self.load = load
+        self.name = name
+        self.state = "idle"
+        self.error = None
+        self.load_seconds = None
+        self.value = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.state != "idle":
+                return
+            self.state = "loading"
+        threading.Thread(target=self._run, name=f"load-{self.name}", daemon=True).start()
+
+    def _run(self):
+        started = time.perf_counter()
+        try:
+            self.value = self.load()
+            self.state = "ready"
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            self.state = "failed"
+            print(f"Loading {self.name} failed: {self.error}")
+        self.load_seconds = time.perf_counter() - started
+        self.done.set()
+
+    def get(self):
+        self.start()
+        self.done.wait()
+        if self.state == "failed":
+            raise RuntimeError(f"Loading {self.name} failed: {self.error}")
+        return self.value
+
+    def status(self):
+        status = {"state": self.state, "error": self.error, "load_seconds": self.load_seconds}
+        if self.state == "ready" and hasattr(self.value, "stats"):
+            status["stats"] = self.value.stats()
+        return status
+
+def launch_with_warmup(iface, loaders, concurrency_limit=1, **launch_options):
+    """Serve ``iface`` at once while ``loaders`` load their models in the background.
+
+    The page shows whether the models are ready, and ``GET /health`` returns
+    the status of every loader (with the metrics of loaded models, see
+    ``BackgroundLoader.status``), with HTTP 200 once all are ready and 503
+    before (or after a failure). SIGTERM shuts the server down through
+    ``sys.exit``, so atexit handlers such as ``ImageWriter.join`` still run.
+    """
+    import gradio as gr
+    from fastapi.responses import JSONResponse
+
+    def readiness():
+        statuses = {loader.name: loader.status() for loader in loaders}
+        return statuses, all(status["state"] == "ready" for status in statuses.values())
+
+    def readiness_text():
+        statuses, ready = readiness()
+        if ready:
+            return "Models loaded."
+        return "Warming up, requests will wait for: " + ", ".join(f"{name} ({status['state']})" for name, status in statuses.items() if status["state"] != "ready")
+
+    def health():
+        statuses, ready = readiness()
+        return JSONResponse(statuses, status_code=200 if ready else 503)
+
+    for loader in loaders:
+        loader.start()
+    with gr.Blocks(title=iface.title) as demo:
+        gr.Markdown(readiness_text, every=2)
+        iface.render()
+    demo.queue(default_concurrency_limit=concurrency_limit)
+    app, _, _ = demo.launch(prevent_thread_lock=True, **launch_options)
+    app.add_api_route("/health", health, methods=["GET"])
+    if threading.current_thread() is threading.main_thread():
+        # The default SIGTERM action (docker stop, systemd, kill) skips atexit
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    try:
+        demo.block_thread()
+    except SystemExit:
+        demo.close()
+        raise
+
+def _tile_spans(length, tile_size, overlap):
+    # (start, end) of overlapping tiles covering range(length); the last tile ends at length
+    if length <= tile_size:
+        return [(0, length)]
+    starts = list(range(0, length - tile_size, tile_size - overlap)) + [length - tile_size]
+    return [(start, start + tile_size) for start in starts]
+
+def _output_spans(spans, scale):
+    # Where each tile lands in the output, and its blend weights along this axis:
+    # a linear ramp across its overlap with the previous tile, 1 elsewhere
+    import numpy as np
+
+    placed, ramps, previous_end = [], [], 0
+    for start, end in spans:
+        start, end = round(start * scale), round(end * scale)
+        overlap = max(previous_end - start, 0)
+        ramp = np.ones(end - start, np.float32)
+        ramp[:overlap] = np.arange(1, overlap + 1) / (overlap + 1)
+        placed.append((start, end))
+        ramps.append(ramp)
+        previous_end = end
+    return placed, ramps
+
+def tiled_upscale(image, size, process, tile_size=1024, overlap=16, workers=2):
+    """Upscale ``image`` to ``size`` tile by tile, so working memory follows the tile size, not the output size.
+
+    The image is split into tiles that come out about ``tile_size`` pixels
+    wide, overlapping by ``overlap`` source pixels. ``process(tile, size)``
+    upscales one tile and returns a PIL image of that size (other sizes are
+    resized to fit). Up to ``workers`` tiles are processed at once, and each
+    one is blended into the output with a linear ramp across its overlap with
+    the tiles before it, so no seams show. Apart from the output itself,
+    memory holds only the tiles in flight.
+    """
+    import numpy as np
+    from PIL import Image
+
+    image = image.convert("RGB")
+    width, height = image.size
+    out_width, out_height = size
+    columns = _tile_spans(width, max(tile_size * width // out_width, 2 * overlap + 1), overlap)
+    rows = _tile_spans(height, max(tile_size * height // out_height, 2 * overlap + 1), overlap)
+    out_columns, column_ramps = _output_spans(columns, out_width / width)
+    out_rows, row_ramps = _output_spans(rows, out_height / height)
+    output = np.zeros((out_height, out_width, 3), np.uint8)
+
+    def upscale_tile(row, column):
+        (left, right), (top, bottom) = columns[column], rows[row]
+        (x0, x1), (y0, y1) = out_columns[column], out_rows[row]
+        tile = process(image.crop((left, top, right, bottom)), (x1 - x0, y1 - y0)).convert("RGB")
+        if tile.size != (x1 - x0, y1 - y0):
+            tile = tile.resize((x1 - x0, y1 - y0), Image.BICUBIC)
+        return np.asarray(tile)
+
+    def blend(row, column, tile):
+        # Tiles are blended in row-major order, so the tiles to the left and above are already in place
+        (x0, x1), (y0, y1) = out_columns[column], out_rows[row]
+        weight = (row_ramps[row][:, None] * column_ramps[column][None, :])[..., None]
+        region = output[y0:y1, x0:x1]
+        region[:] = region * (1 - weight) + tile * weight + 0.5
+
+    with ThreadPoolExecutor(workers) as pool:
+        pending = deque()
+        for row in range(len(rows)):
+            for column in range(len(columns)):
+                pending.append((row, column, pool.submit(upscale_tile, row, column)))
+                # Keep at most one tile per worker waiting, so finished tiles do not pile up
+                while len(pending) > workers:
+                    row_done, column_done, future = pending.popleft()
+                    blend(row_done, column_done, future.result())
+        for row_done, column_done, future in pending:
+            blend(row_done, column_done, future.result())
+    return Image.fromarray(output)
+
+def tiny_pipeline(seed=0):
+    """A randomly initialised, miniature Stable Diffusion pipeline producing 64x64 images.
+
+    It runs the same code paths as the real model, needs no download or
+    network connection, and takes milliseconds per step, which makes it the
+    model for smoke tests and benchmarks of everything around the model.
+    """
+    import torch
+    from diffusers import AutoencoderKL, PNDMScheduler, StableDiffusionPipeline, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    torch.manual_seed(seed)
+    unet = UNet2DConditionModel(
+        block_out_channels=(4, 8), layers_per_block=1, sample_size=32, in_channels=4, out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"), up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32, norm_num_groups=2)
+    vae = AutoencoderKL(
+        block_out_channels=[4, 8], in_channels=3, out_channels=3, latent_channels=4, norm_num_groups=2,
+        down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"], up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"])
+    scheduler = PNDMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", skip_prk_steps=True, steps_offset=1)
+
+    # Character-level CLIP vocabulary: every byte is a token and there are no merges
+    characters = list(bytes_to_unicode().values())
+    tokens = ["<|startoftext|>", "<|endoftext|>"] + characters + [character + "</w>" for character in characters]
+    with tempfile.TemporaryDirectory() as vocab_dir:
+        vocab_file = os.path.join(vocab_dir, "vocab.json")
+        merges_file = os.path.join(vocab_dir, "merges.txt")
+        with open(vocab_file, "w", encoding="utf-8") as file:
+            json.dump({token: index for index, token in enumerate(tokens)}, file)
+        with open(merges_file, "w", encoding="utf-8") as file:
+            file.write("#version: 0.2\n")
+        tokenizer = CLIPTokenizer(vocab_file, merges_file, model_max_length=77, clean_up_tokenization_spaces=True)
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        bos_token_id=0, eos_token_id=1, pad_token_id=1, vocab_size=len(tokens), hidden_size=32, intermediate_size=64,
+        num_attention_heads=8, num_hidden_layers=3, layer_norm_eps=1e-05))
+
+    return StableDiffusionPipeline(vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, unet=unet, scheduler=scheduler,
+                                   safety_checker=None, feature_extractor=None, requires_safety_checker=False)